@@ -0,0 +1,168 @@
+import time
+
+class NewReno:
+    def __init__(self, smss):
+        self.smss = smss
+        self.cwnd = 2*smss if smss>2190 else 3*smss if smss>1095 else 4*smss
+        self.ssthresh = 0x7fffffff
+        self.recovery = False
+    @property
+    def pacing_rate(self):
+        return None
+    def on_send(self):
+        pass
+    def on_ack(self, acked, rtt, inflight, recovery):
+        if self.recovery and recovery:
+            if acked:
+                # partial ack, deflate by the amount of new data acked
+                self.cwnd = max(self.cwnd-acked+self.smss, self.ssthresh)
+            else:
+                self.cwnd += self.smss
+            return
+        if self.recovery:
+            self.recovery = False
+            self.cwnd = self.ssthresh
+        if not acked:
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += min(acked, self.smss)
+        else:
+            self.cwnd += max(1, self.smss*self.smss//self.cwnd)
+    def on_loss(self, inflight):
+        self.ssthresh = max(inflight//2, 2*self.smss)
+        self.cwnd = self.ssthresh+3*self.smss
+        self.recovery = True
+    def on_rto(self, inflight):
+        self.ssthresh = max(inflight//2, 2*self.smss)
+        self.cwnd = self.smss
+        self.recovery = False
+
+class Cubic(NewReno):
+    C = 0.4
+    BETA = 0.7
+    def __init__(self, smss):
+        NewReno.__init__(self, smss)
+        self.w_max = 0
+        self.k = 0
+        self.epoch = None
+        self.w_est = 0
+        self.srtt = None
+    def on_ack(self, acked, rtt, inflight, recovery):
+        if rtt is not None:
+            self.srtt = rtt if self.srtt is None else 0.875*self.srtt+0.125*rtt
+        if self.recovery and recovery:
+            return
+        if self.recovery:
+            self.recovery = False
+            self.cwnd = self.ssthresh
+        if not acked:
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += min(acked, self.smss)
+            return
+        now = time.perf_counter()
+        if self.epoch is None:
+            self.epoch = now
+            self.w_est = self.cwnd
+            if self.cwnd < self.w_max:
+                self.k = ((self.w_max-self.cwnd)/self.smss/self.C) ** (1/3)
+            else:
+                self.k = 0
+                self.w_max = self.cwnd
+        t = now-self.epoch+(self.srtt or 0)
+        target = self.w_max + self.C*(t-self.k)**3*self.smss
+        target = min(max(target, self.cwnd), 1.5*self.cwnd)
+        # reno-friendly region
+        self.w_est += 3*(1-self.BETA)/(1+self.BETA)*self.smss*acked/self.cwnd
+        if self.w_est > target:
+            target = self.w_est
+        self.cwnd += max(1, int((target-self.cwnd)*acked/self.cwnd))
+    def on_loss(self, inflight):
+        # fast convergence
+        self.w_max = self.cwnd*(1+self.BETA)/2 if self.cwnd < self.w_max else self.cwnd
+        self.ssthresh = max(int(self.cwnd*self.BETA), 2*self.smss)
+        self.cwnd = self.ssthresh
+        self.epoch = None
+        self.recovery = True
+    def on_rto(self, inflight):
+        self.w_max = self.cwnd
+        self.ssthresh = max(int(self.cwnd*self.BETA), 2*self.smss)
+        self.cwnd = self.smss
+        self.epoch = None
+        self.recovery = False
+
+class BBR:
+    STARTUP_GAIN = 2.885
+    CYCLE = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+    BW_WINDOW = 10
+    RTT_WINDOW = 10
+    def __init__(self, smss):
+        self.smss = smss
+        self.cwnd = 10*smss
+        self.ssthresh = 0x7fffffff
+        self.mode = 'STARTUP'
+        self.pacing_gain = self.cwnd_gain = self.STARTUP_GAIN
+        self.bw_samples = []
+        self.full_bw = 0
+        self.full_bw_count = 0
+        self.min_rtt = None
+        self.min_rtt_stamp = 0
+        self.round_start = None
+        self.round_delivered = 0
+        self.delivered = 0
+        self.cycle_index = 0
+    @property
+    def btl_bw(self):
+        return max(self.bw_samples) if self.bw_samples else 0
+    @property
+    def pacing_rate(self):
+        if not self.btl_bw:
+            return None
+        return self.pacing_gain*self.btl_bw
+    def on_send(self):
+        if self.round_start is None:
+            # the first round starts with the first data segment
+            self.round_start = time.perf_counter()
+    def bdp(self):
+        return self.btl_bw*self.min_rtt if self.min_rtt and self.btl_bw else self.cwnd
+    def on_ack(self, acked, rtt, inflight, recovery):
+        now = time.perf_counter()
+        self.delivered += acked
+        if rtt is not None and (self.min_rtt is None or rtt <= self.min_rtt or now-self.min_rtt_stamp > self.RTT_WINDOW):
+            self.min_rtt = rtt
+            self.min_rtt_stamp = now
+        if self.round_start is None or self.min_rtt is None or now-self.round_start < self.min_rtt:
+            return
+        if self.delivered == self.round_delivered:
+            return
+        # one round trip has elapsed, take a delivery rate sample
+        self.bw_samples.append((self.delivered-self.round_delivered)/(now-self.round_start))
+        del self.bw_samples[:-self.BW_WINDOW]
+        self.round_start = now
+        self.round_delivered = self.delivered
+        if self.mode == 'STARTUP':
+            if self.btl_bw >= self.full_bw*1.25:
+                self.full_bw = self.btl_bw
+                self.full_bw_count = 0
+            else:
+                self.full_bw_count += 1
+                if self.full_bw_count >= 3:
+                    self.mode = 'DRAIN'
+                    self.pacing_gain = 1/self.STARTUP_GAIN
+                    self.cwnd_gain = self.STARTUP_GAIN
+        elif self.mode == 'DRAIN':
+            if inflight <= self.bdp():
+                self.mode = 'PROBE_BW'
+                self.cycle_index = 0
+                self.cwnd_gain = 2
+        else:
+            self.cycle_index = (self.cycle_index+1) % len(self.CYCLE)
+        if self.mode == 'PROBE_BW':
+            self.pacing_gain = self.CYCLE[self.cycle_index]
+        self.cwnd = max(int(self.cwnd_gain*self.bdp()), 4*self.smss)
+    def on_loss(self, inflight):
+        self.cwnd = max(min(self.cwnd, inflight), 4*self.smss)
+    def on_rto(self, inflight):
+        self.cwnd = 4*self.smss
+
+ALGORITHMS = dict(newreno=NewReno, cubic=Cubic, bbr=BBR)
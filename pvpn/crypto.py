@@ -102,6 +102,10 @@ class Crypto:
         plain += b'\x00' * padlen + bytes([padlen, next_header])
         encrypted = self.cipher.encrypt(self.sk_e, bytes(iv), bytes(plain))
         return iv + encrypted + bytes(self.integrity.hash_size)
+    def esp_mtu(self, mtu):
+        # largest inner packet that fits into an udp encapsulated esp packet of size mtu
+        size = mtu-20-8-8-self.cipher.block_size-self.integrity.hash_size
+        return size//self.cipher.block_size*self.cipher.block_size-2
     def encrypt_1(self, plain, m_id):
         if m_id not in self.iv:
             self.iv[m_id] = self.prf.hasher(self.iv[0]+m_id.to_bytes(4, 'big')).digest()[:self.cipher.block_size]
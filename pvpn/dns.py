@@ -1,4 +1,4 @@
-import base64, binascii, struct, time, fnmatch, ipaddress
+import base64, binascii, struct, time, fnmatch, ipaddress, collections, os, re, asyncio
 
 class DNSError(Exception):
     pass
@@ -420,26 +420,454 @@ class RRSIG(Struct):
 RDMAP = dict(CNAME=CNAME, DNAME=DNAME, A=A, AAAA=AAAA, TXT=TXT, MX=MX, PTR=PTR, SOA=SOA, NS=NS,
              NAPTR=NAPTR, SRV=SRV, DNSKEY=DNSKEY, RRSIG=RRSIG)
 
+def skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset+1
+        if length & 0xc0 == 0xc0:
+            return offset+2
+        offset += length+1
+
+def parse_question(data):
+    # (id, key, name) of a single question packet, key is the question section with the name
+    # lowercased, name is the client's spelling which answers echo for 0x20 randomization
+    if len(data) < 17 or data[4:6] != b'\x00\x01':
+        return None
+    offset = 12
+    while offset < len(data) and data[offset]:
+        if data[offset] > 63:
+            return None
+        offset += data[offset]+1
+    if offset+5 > len(data):
+        return None
+    name = bytes(data[12:offset+1])
+    return int.from_bytes(data[0:2], 'big'), name.lower()+bytes(data[offset+1:offset+5]), name
+
+def restamp(data, qid, name):
+    # a stored answer with the asker's id and spelling of the name
+    answer = bytearray(data)
+    answer[0:2] = qid.to_bytes(2, 'big')
+    answer[12:12+len(name)] = name
+    return answer
+
+def question_name(key):
+    labels = []
+    offset = 0
+    while key[offset]:
+        labels.append(key[offset+1:offset+1+key[offset]].decode(errors='replace'))
+        offset += key[offset]+1
+    return '.'.join(labels)+'.'
+
+def udp_limit(data):
+    # largest udp answer the client accepts, RFC 6891
+    try:
+        qd, an, ns, ar = struct.unpack('>4H', data[4:12])
+        offset = 12
+        for i in range(qd):
+            offset = skip_name(data, offset)+4
+        for i in range(an+ns+ar):
+            offset = skip_name(data, offset)
+            rtype, rclass, ttl, rdlength = struct.unpack('>HHIH', data[offset:offset+10])
+            if rtype == QTYPE_OPT:
+                return max(rclass, 512)
+            offset += 10+rdlength
+    except (struct.error, IndexError):
+        pass
+    return 512
+
+def truncate(data, limit):
+    # keep the question and set TC, the client retries over tcp
+    if len(data) <= limit:
+        return data
+    offset = 12
+    for i in range(int.from_bytes(data[4:6], 'big')):
+        offset = skip_name(data, offset)+4
+    header = bytearray(data[:12])
+    header[2] |= 0x02
+    header[6:12] = bytes(6)
+    return bytes(header)+bytes(data[12:offset])
+
+def ttl_offsets(data):
+    # offsets of the ttl field of every rr, OPT excluded
+    qd, an, ns, ar = struct.unpack('>4H', data[4:12])
+    offset = 12
+    for i in range(qd):
+        offset = skip_name(data, offset)+4
+    offsets = []
+    for i in range(an+ns+ar):
+        offset = skip_name(data, offset)
+        rtype, _, ttl, rdlength = struct.unpack('>HHIH', data[offset:offset+10])
+        if rtype != QTYPE_OPT:
+            offsets.append((offset+4, ttl))
+        offset += 10+rdlength
+    if offset > len(data):
+        raise DNSError(f'Truncated packet [offset={offset}]')
+    return offsets
+
+SNAPSHOT_MAGIC = b'PVDNS\x01'
+ENTRY = struct.Struct('>ddIHHH')
+RDNS = struct.Struct('>dBB')
+
 class DNSCache(object):
-    def __init__(self):
-        self.cache = {}
-        self.rdns = {}
-    def query(self, record):
-        if len(record.questions) == 1:
-            if record.q in self.cache:
-                answer = self.cache[record.q]
-                answer.header.id = record.header.id
-                for r in answer.rr:
-                    if r.rtype in (1, 5, 39) and r.rclass == 1:
-                        self.rdns[str(r.rdata)] = str(r.rname)
-                return answer
-    def answer(self, record):
-        if len(record.questions) == 1 and record.rr:
-            self.cache[record.q] = record
-        for r in record.rr:
-            if r.rtype in (1, 5, 39) and r.rclass == 1:
-                self.rdns[str(r.rdata)] = str(r.rname)
+    def __init__(self, size=4096, maxttl=86400, stale=3600, popular=3, client_timeout=1.8):
+        self.size = size
+        self.maxttl = maxttl
+        self.stale = stale
+        self.client_timeout = client_timeout
+        self.popular = popular
+        self.refresh = None
+        self.cache = collections.OrderedDict()
+        self.rdns = collections.OrderedDict()
+        self.pending = collections.OrderedDict()
+        self.coalesced = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetches = 0
+        self.stales = 0
+    def __str__(self):
+        return f'DNSCache {len(self.cache)}/{self.size} Hits={self.hits} Misses={self.misses} Evictions={self.evictions} Coalesced={self.coalesced} Prefetches={self.prefetches} Stale={self.stales}'
+    def add_rdns(self, names, expire):
+        for ip, name in names:
+            self.rdns[ip] = (name, expire)
+            self.rdns.move_to_end(ip)
+        while len(self.rdns) > self.size:
+            self.rdns.popitem(last=False)
+    def query(self, key, qid, name):
+        entry = self.cache.get(key)
+        now = time.time()
+        if entry is None or entry[0] <= now:
+            # expired answers are kept for stale_answer() until the upstream replies
+            if entry is not None and (not self.refresh or entry[0]+self.stale <= now):
+                del self.cache[key]
+            self.misses += 1
+            return
+        expire, stored, data, ttls, names, hits, refreshed = entry
+        self.cache.move_to_end(key)
+        entry[5] += 1
+        self.hits += 1
+        answer = restamp(data, qid, name)
+        elapsed = int(now-stored)
+        for offset, ttl in ttls:
+            answer[offset:offset+4] = max(ttl-elapsed, 0).to_bytes(4, 'big')
+        self.add_rdns(names, expire)
+        if hits >= self.popular and expire-now < max((expire-stored)/10, 2) and now-refreshed > 5:
+            entry[6] = now
+            self.prefetches += 1
+            self.refresh(key)
+        return bytes(answer)
+    def stale_answer(self, key, qid, name):
+        # RFC 8767: an expired answer with a 30s ttl, only for a slow or failing upstream
+        entry = self.cache.get(key)
+        if entry is None or not self.refresh or entry[0]+self.stale <= time.time():
+            return
+        self.stales += 1
+        answer = restamp(entry[2], qid, name)
+        for offset, ttl in entry[3]:
+            answer[offset:offset+4] = (30).to_bytes(4, 'big')
+        return bytes(answer)
+    def answer(self, data):
+        record = DNSRecord.unpack(data)
+        now = time.time()
+        rcode = record.header.bitmap & 0x0f
+        if record.rr:
+            ttl = min([self.maxttl]+[r.ttl for r in record.rr+record.auth if r.rtype != QTYPE_OPT])
+        else:
+            # RFC 2308: NXDOMAIN or NODATA lives min(SOA ttl, SOA minimum), not at all without an SOA
+            soa = [min(r.ttl, r.rdata.t4) for r in record.auth if r.rtype == 6]
+            ttl = min([self.maxttl]+soa) if soa else 0
+        names = [(str(r.rdata), str(r.rname)) for r in record.rr if r.rtype in (1, 5, 39) and r.rclass == 1]
+        question = parse_question(data)
+        if question and rcode in (0, 3) and not record.header.bitmap & 0x0200 and ttl > 0:
+            key = question[1]
+            ttls = [(offset, min(i, ttl)) for offset, i in ttl_offsets(data)] if not record.rr else ttl_offsets(data)
+            hits = self.cache[key][5] if key in self.cache else 0
+            self.cache[key] = [now+ttl, now, bytes(data), ttls, names, hits, 0]
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+        self.add_rdns(names, now+max(ttl, 0))
+        return record
+    def save(self, path):
+        out = bytearray(SNAPSHOT_MAGIC)
+        out.extend(struct.pack('>I', len(self.cache)))
+        for expire, stored, data, ttls, names, hits, refreshed in self.cache.values():
+            names = [(i.encode(), j.encode()) for i, j in names]
+            out.extend(ENTRY.pack(expire, stored, hits, len(data), len(ttls), len(names)))
+            out.extend(data)
+            for offset, ttl in ttls:
+                out.extend(struct.pack('>HI', offset, ttl))
+            for i, j in names:
+                out.extend(bytes([len(i), len(j)])+i+j)
+        out.extend(struct.pack('>I', len(self.rdns)))
+        for i, (j, expire) in self.rdns.items():
+            i, j = i.encode(), j.encode()
+            out.extend(RDNS.pack(expire, len(i), len(j))+i+j)
+        with open(path+'.tmp', 'wb') as f:
+            f.write(out)
+        os.replace(path+'.tmp', path)
+    def load(self, path):
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise DNSError(f'Bad snapshot {path}')
+        now = time.time()
+        offset = len(SNAPSHOT_MAGIC)
+        count, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        for _ in range(count):
+            expire, stored, hits, length, nttls, nnames = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            packet = bytes(data[offset:offset+length])
+            offset += length
+            ttls = [struct.unpack_from('>HI', data, offset+i*6) for i in range(nttls)]
+            offset += nttls*6
+            names = []
+            for _ in range(nnames):
+                i, j = data[offset], data[offset+1]
+                names.append((bytes(data[offset+2:offset+2+i]).decode(), bytes(data[offset+2+i:offset+2+i+j]).decode()))
+                offset += 2+i+j
+            question = parse_question(packet)
+            if question and expire+self.stale > now:
+                self.cache[question[1]] = [expire, stored, packet, ttls, names, hits, 0]
+        count, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        for _ in range(count):
+            expire, i, j = RDNS.unpack_from(data, offset)
+            offset += RDNS.size
+            if expire > now:
+                self.rdns[bytes(data[offset:offset+i]).decode()] = (bytes(data[offset+i:offset+i+j]).decode(), expire)
+            offset += i+j
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        while len(self.rdns) > self.size:
+            self.rdns.popitem(last=False)
+    def join(self, key, qid, name, callback, client=None, window=1, timeout=5):
+        # True if an identical question went upstream less than window seconds ago
+        now = time.time()
+        while self.pending:
+            q, (stamp, _) = next(iter(self.pending.items()))
+            if now-stamp < timeout:
+                break
+            del self.pending[q]
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = [now, [(qid, name, callback, client, True)]]
+            return False
+        waiters = entry[1]
+        # a client retrying the same query is never parked behind itself
+        retry = [i for i in waiters if i[0] == qid and i[3] == client]
+        for i in retry:
+            waiters.remove(i)
+        direct = bool(retry) or now-entry[0] >= window
+        waiters.append((qid, name, callback, client, direct))
+        if direct:
+            entry[0] = now
+            self.pending.move_to_end(key)
+            return False
+        self.coalesced += 1
+        return True
+    def cancel(self, key):
+        self.pending.pop(key, None)
+    def expire(self, key):
+        # the upstream is slow, answer everyone waiting from stale data
+        entry = self.pending.get(key)
+        if entry is None or entry[0]+self.client_timeout > time.time()+0.1:
+            return
+        answers = [self.stale_answer(key, qid, name) for qid, name, callback, client, direct in entry[1]]
+        if None in answers:
+            return
+        del self.pending[key]
+        for (qid, name, callback, client, direct), answer in zip(entry[1], answers):
+            callback(answer)
+    def release(self, data):
+        # answers the parked waiters, returns the reply for the sender
+        question = parse_question(data)
+        if question is None:
+            return data
+        if data[3] & 0x0f not in (0, 3):
+            qid, key, name = question
+            data = self.stale_answer(key, qid, name) or data
+        if question[1] not in self.pending:
+            return data
+        _, waiters = self.pending.pop(question[1])
+        for qid, name, callback, client, direct in waiters:
+            # direct senders get their own reply
+            if not direct:
+                callback(bytes(restamp(data, qid, name)))
+        return data
     def ip2domain(self, ip):
-        while ip in self.rdns:
-            ip = self.rdns[ip]
+        now = time.time()
+        seen = set()
+        while ip in self.rdns and ip not in seen:
+            seen.add(ip)
+            name, expire = self.rdns[ip]
+            if expire <= now:
+                del self.rdns[ip]
+                break
+            ip = name
         return ip.rstrip('.')
+
+class LocalZone(object):
+    def __init__(self):
+        self.names = {}
+        self.wildcards = {}
+        self.globs = []
+        self.hits = 0
+    def __len__(self):
+        return len(self.names)+len(self.wildcards)+len(self.globs)
+    def add(self, rr):
+        name = str(rr.rname).lower()
+        if name.startswith('*.') and len(name) > 2 and '*' not in name[2:] and '?' not in name and '[' not in name:
+            self.wildcards.setdefault(name[2:], []).append(rr)
+        elif '*' in name or '?' in name or '[' in name:
+            pattern = re.compile(fnmatch.translate(name))
+            for glob, rrs in self.globs:
+                if glob.pattern == pattern.pattern:
+                    rrs.append(rr)
+                    break
+            else:
+                self.globs.append((pattern, [rr]))
+        else:
+            self.names.setdefault(name, []).append(rr)
+    def load(self, path, ttl=60):
+        with open(path) as f:
+            for line in f:
+                line = line.split('#')[0].split(';')[0].strip()
+                if not line:
+                    continue
+                first, *rest = line.split()
+                try:
+                    address = ipaddress.ip_address(first)
+                except ValueError:
+                    for rr in RR.fromZone(line, ttl=ttl):
+                        self.add(rr)
+                    continue
+                # hosts file line
+                rtype, rd = (1, A) if address.version == 4 else (28, AAAA)
+                for name in rest:
+                    self.add(RR(rname=DNSLabel(name), rtype=rtype, ttl=ttl, rdata=rd(address)))
+    def lookup(self, name):
+        if name in self.names:
+            return self.names[name]
+        parent = name
+        while '.' in parent[:-1]:
+            parent = parent.split('.', 1)[1]
+            if parent in self.wildcards:
+                return self.wildcards[parent]
+        for glob, rrs in self.globs:
+            if glob.match(name):
+                return rrs
+    def rdns(self):
+        return [(str(rr.rdata), str(rr.rname)) for rrs in self.names.values() for rr in rrs if rr.rtype in (1, 5, 39)]
+    def answer(self, data, question):
+        qid, key, name = question
+        rrs = self.lookup(question_name(key))
+        if rrs is None:
+            return
+        self.hits += 1
+        # echo the client's spelling of the name
+        name = question_name(name)
+        qtype, qclass = struct.unpack('>HH', key[-4:])
+        flags = 0x8480 | int.from_bytes(data[2:4], 'big') & 0x0100
+        record = DNSRecord(DNSHeader(qid, flags), q=DNSQuestion(DNSLabel(name), qtype, qclass))
+        for i in range(8):
+            matched = [rr for rr in rrs if qtype in (rr.rtype, 255)]
+            for rr in matched:
+                record.add_answer(RR(DNSLabel(name), rr.rtype, rr.rclass, rr.ttl, rr.rdata))
+            cnames = [rr for rr in rrs if rr.rtype == 5]
+            if matched or not cnames:
+                break
+            record.add_answer(RR(DNSLabel(name), 5, cnames[0].rclass, cnames[0].ttl, cnames[0].rdata))
+            name = str(cnames[0].rdata)
+            rrs = self.lookup(name.lower())
+            if rrs is None:
+                break
+        return record.pack()
+
+class TCPStream(object):
+    def __init__(self):
+        self.writer = None
+        self.connecting = False
+        self.pending = collections.OrderedDict()
+        self.backlog = []
+
+class TCPResolver(object):
+    # RFC 7766 pipelined queries over a few persistent connections
+    def __init__(self, conn, host, port=53, size=2, timeout=5):
+        self.conn = conn
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.streams = [TCPStream() for i in range(size)]
+    def query(self, data, callback, retries=1):
+        # callback gets the answer, or None if the upstream failed
+        stream = min(self.streams, key=lambda s: len(s.pending))
+        qid = int.from_bytes(os.urandom(2), 'big')
+        while qid in stream.pending:
+            qid = (qid+1) & 0xffff
+        stream.pending[qid] = (time.time(), data[:2], callback, data, retries)
+        asyncio.get_event_loop().call_later(self.timeout, self.check, stream)
+        frame = struct.pack('>HH', len(data), qid)+data[2:]
+        if stream.writer:
+            stream.writer.write(frame)
+        else:
+            stream.backlog.append(frame)
+            if not stream.connecting:
+                stream.connecting = True
+                asyncio.ensure_future(self.connect(stream))
+    def check(self, stream):
+        if not stream.pending or stream.writer is None:
+            return
+        stamp = next(iter(stream.pending.values()))[0]
+        if time.time()-stamp >= self.timeout:
+            # stalled, the read loop resends what is pending on a new connection
+            stream.writer.close()
+    def fail(self, pending):
+        for stamp, qid, callback, data, retries in pending:
+            try:
+                callback(None)
+            except Exception as e:
+                print(e)
+    async def connect(self, stream):
+        try:
+            reader, writer = await asyncio.wait_for(self.conn.tcp_connect(self.host, self.port), self.timeout)
+        except Exception as e:
+            print(f'DNS over TCP {self.host}:{self.port} failed: {e}')
+            stream.connecting = False
+            pending = list(stream.pending.values())
+            stream.pending.clear()
+            stream.backlog.clear()
+            self.fail(pending)
+            return
+        stream.connecting = False
+        stream.writer = writer
+        for frame in stream.backlog:
+            writer.write(frame)
+        stream.backlog.clear()
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                packet = await reader.readexactly(length)
+                entry = stream.pending.pop(int.from_bytes(packet[:2], 'big'), None)
+                if entry:
+                    try:
+                        entry[2](entry[1]+packet[2:])
+                    except Exception as e:
+                        print(e)
+        except Exception:
+            pass
+        stream.writer = None
+        try:
+            writer.close()
+        except Exception:
+            pass
+        # the server may close idle or busy connections, resend what was lost
+        pending = list(stream.pending.values())
+        stream.pending.clear()
+        self.fail([i for i in pending if not i[4]])
+        for stamp, qid, callback, data, retries in pending:
+            if retries:
+                self.query(data, callback, retries-1)
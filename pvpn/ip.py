@@ -1,28 +1,125 @@
-import struct, ipaddress, os, asyncio, random, heapq, collections, time, enum
-from . import enums
+import struct, os, asyncio, random, heapq, collections, itertools, time, enum, math
+from . import congestion
 
 SMSS = 1350
+RCVBUF = 1<<20
+SNDBUF = 1<<20
+WSCALE = 5
+MSL = 60
+ACK_DELAY = 0.04
+EARLYBUF = 1<<16
+UDP_TIMEOUT = 60
+FRAG_TIMEOUT = 30
+FRAGBUF = 1<<22
+RTO_RETRIES = 8
+TCP_IDLE = 7440
 
 def parse_ipv4(data):
+    # addresses stay packed, see socket.inet_ntoa for display
     ihl = data[0]&0x0f
-    proto = enums.IpProto(data[9])
-    src_ip = ipaddress.ip_address(data[12:16])
-    dst_ip = ipaddress.ip_address(data[16:20])
-    body = data[ihl<<2:]
-    return proto, src_ip, dst_ip, body
+    return data[9], data[12:16], data[16:20], data[ihl<<2:]
 
-def checksum(data):
-    x = sum(struct.unpack(f'>{len(data)//2}H', data))
-    while x > 0xffff:
-        x = (x>>16)+(x&0xffff)
-    x = 65535 - x
-    return x.to_bytes(2, 'big')
+TCP_HEADER = struct.Struct('>HHIIBBHHH')
 
-def make_ipv4(proto, src_ip, dst_ip, body):
-    ip_header = bytearray(struct.pack('>BxH2s2xBB2x4s4s', 0x45, len(body)+20, os.urandom(2), 64,
-        proto, src_ip.packed, dst_ip.packed))
+class Fragments:
+    def __init__(self, now):
+        self.header = None
+        self.created = now
+        self.total = None
+        self.body = bytearray()
+        self.mask = bytearray()
+        self.units = 0
+
+class Reassembler:
+    def __init__(self, limit=FRAGBUF, timeout=FRAG_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self.pending = {}
+        self.size = 0
+        self.dropped = 0
+    def evict(self, key):
+        frags = self.pending.pop(key)
+        self.size -= len(frags.body)
+        self.dropped += 1
+    def feed(self, data, addr=None):
+        flags = int.from_bytes(data[6:8], 'big')
+        if flags & 0x3fff == 0:
+            return data
+        now = time.perf_counter()
+        while self.pending:
+            key = next(iter(self.pending))
+            if now-self.pending[key].created < self.timeout:
+                break
+            self.evict(key)
+        ihl = (data[0]&0x0f)<<2
+        offset = (flags&0x1fff)<<3
+        payload = data[ihl:int.from_bytes(data[2:4], 'big')]
+        end = offset+len(payload)
+        if end > 65535-ihl or flags & 0x2000 and len(payload) & 7:
+            return None
+        # clients share inner addresses, the outer address tells them apart
+        key = (addr, data[12:20], data[9], data[4:6])
+        frags = self.pending.get(key)
+        if frags is None:
+            frags = self.pending[key] = Fragments(now)
+        if len(frags.body) < end:
+            grow = end-len(frags.body)
+            while self.size+grow > self.limit and len(self.pending) > 1:
+                self.evict(next(k for k in self.pending if k != key))
+            if self.size+grow > self.limit:
+                self.evict(key)
+                return None
+            frags.body.extend(bytes(grow))
+            frags.mask.extend(bytes((end+7>>3)-len(frags.mask)))
+            self.size += grow
+        frags.body[offset:end] = payload
+        for i in range(offset>>3, end+7>>3):
+            if not frags.mask[i]:
+                frags.mask[i] = 1
+                frags.units += 1
+        if offset == 0:
+            frags.header = bytearray(data[:ihl])
+        if not flags & 0x2000:
+            frags.total = end
+        if frags.header is None or frags.total is None or frags.units < (frags.total+7>>3):
+            return None
+        del self.pending[key]
+        self.size -= len(frags.body)
+        header = frags.header
+        header[2:4] = (len(header)+frags.total).to_bytes(2, 'big')
+        header[6:8] = bytes(2)
+        header[10:12] = bytes(2)
+        header[10:12] = checksum(header)
+        return bytes(header+frags.body[:frags.total])
+
+def fold(data, x=0):
+    # one's complement sum, 2**16 == 1 (mod 0xffff)
+    n = int.from_bytes(data, 'big')
+    return (x + (n<<8 if len(data)&1 else n)) % 0xffff
+
+def checksum(data, x=0):
+    return (0xffff-fold(data, x)).to_bytes(2, 'big')
+
+def checksum_adjust(csum, old, new):
+    # RFC 1624: HC' = ~(~HC + ~m + m')
+    x = 0xffff-int.from_bytes(csum, 'big') + 0xffff-fold(old) + fold(new)
+    return (0xffff-x%0xffff).to_bytes(2, 'big')
+
+def ipv4_header(proto, src_ip, dst_ip, length=0, df=False):
+    ip_header = bytearray(struct.pack('>BxH2sHBB2x4s4s', 0x45, length+20, os.urandom(2), 0x4000 if df else 0, 64,
+        proto, src_ip, dst_ip))
     ip_header[10:12] = checksum(ip_header)
-    return bytes(ip_header+body)
+    return ip_header
+
+def ipv4_resize(ip_header, length):
+    ip_header = bytearray(ip_header)
+    old = ip_header[2:4]
+    ip_header[2:4] = (length+20).to_bytes(2, 'big')
+    ip_header[10:12] = checksum_adjust(ip_header[10:12], old, ip_header[2:4])
+    return ip_header
+
+def make_ipv4(proto, src_ip, dst_ip, body):
+    return b''.join((ipv4_header(proto, src_ip, dst_ip, len(body)), body))
 
 def parse_udp(data):
     src_port, dst_port = struct.unpack('>HH', data[:4])
@@ -35,6 +132,16 @@ def parse_icmp(data):
     icmptp, code = struct.unpack('>BB', data[:2])
     return icmptp, code, data[8:]
 
+def make_icmp(icmptp, code, body, rest=bytes(4)):
+    icmp = bytearray(struct.pack('>BBH4s', icmptp, code, 0, rest))
+    icmp.extend(body)
+    icmp[2:4] = checksum(icmp)
+    return bytes(icmp)
+
+def frag_needed(data, mtu):
+    # original header plus the first 8 bytes of payload
+    return make_icmp(3, 4, data[:((data[0]&0x0f)<<2)+8], struct.pack('>xxH', mtu))
+
 def parse_tcp(data):
     src_port, dst_port = struct.unpack('>HH', data[:4])
     offset = data[12]
@@ -42,6 +149,32 @@ def parse_tcp(data):
     body = data[offset>>2:]
     return src_port, dst_port, flag, body
 
+def make_rst(src_ip, dst_ip, data):
+    # stateless reply to a segment that matches no connection
+    src_port, dst_port, seq, ack, offset, flag = struct.unpack('>HHIIBB', data[:14])
+    if flag & Control.RST:
+        return None
+    if flag & Control.ACK:
+        seq, ack, flag = ack, 0, Control.RST
+    else:
+        seq, ack, flag = 0, seq+len(data)-(offset>>2)+(1 if flag & Control.FIN else 0), Control.RST|Control.ACK
+    tcp_header = bytearray(TCP_HEADER.pack(dst_port, src_port, seq, ack&0xffffffff, 0x50, flag, 0, 0, 0))
+    tcp_header[16:18] = checksum(tcp_header, fold(dst_ip+src_ip, 6)+len(tcp_header))
+    return make_ipv4(6, dst_ip, src_ip, tcp_header)
+
+def parse_tcp_options(data):
+    options = {}
+    i = 0
+    while i < len(data) and data[i] != Option.EOL:
+        if data[i] == Option.NOP:
+            i += 1
+            continue
+        if i+1 >= len(data) or data[i+1] < 2:
+            break
+        options[data[i]] = data[i+2:i+data[i+1]]
+        i += data[i+1]
+    return options
+
 class State(enum.Enum):
     LISTEN = 0
     SYN_SENT = 1
@@ -64,8 +197,187 @@ class Control(enum.IntFlag):
     ACK = 0x10
     URG = 0x20
 
+class Option(enum.IntEnum):
+    EOL = 0
+    NOP = 1
+    MSS = 2
+    WSCALE = 3
+    SACK_PERM = 4
+    SACK = 5
+    TIMESTAMP = 8
+
+class SendQueue:
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.offset = 0
+        self.size = 0
+    def __len__(self):
+        return self.size
+    def extend(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+    def consume(self, length):
+        length = min(length, self.size)
+        self.size -= length
+        while length:
+            left = len(self.chunks[0])-self.offset
+            if length < left:
+                self.offset += length
+                break
+            length -= left
+            self.chunks.popleft()
+            self.offset = 0
+    def peek(self, start, length):
+        start += self.offset
+        for index, chunk in enumerate(self.chunks):
+            if start < len(chunk):
+                if start+length <= len(chunk):
+                    return memoryview(chunk)[start:start+length]
+                break
+            start -= len(chunk)
+        else:
+            return b''
+        result = bytearray()
+        for chunk in itertools.islice(self.chunks, index, None):
+            result.extend(memoryview(chunk)[start:start+length-len(result)])
+            start = 0
+            if len(result) >= length:
+                break
+        return result
+
+class TimerWheel:
+    def __init__(self, tick=0.02, size=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(size)]
+        self.index = 0
+        self.pending = 0
+        self.time = None
+        self.handle = None
+    def schedule(self, deadline, callback):
+        if self.handle is None:
+            self.time = time.perf_counter()
+            self.handle = asyncio.get_event_loop().call_later(self.tick, self.run)
+        ticks = max(1, math.ceil((deadline-self.time)/self.tick))
+        self.slots[(self.index+ticks) % len(self.slots)].append([(ticks-1)//len(self.slots), callback])
+        self.pending += 1
+    def run(self):
+        now = time.perf_counter()
+        while self.time+self.tick <= now:
+            self.time += self.tick
+            self.index = (self.index+1) % len(self.slots)
+            slot = self.slots[self.index]
+            if not slot:
+                continue
+            self.slots[self.index] = []
+            for entry in slot:
+                if entry[0]:
+                    entry[0] -= 1
+                    self.slots[self.index].append(entry)
+                else:
+                    self.pending -= 1
+                    entry[1]()
+        if self.pending:
+            self.handle = asyncio.get_event_loop().call_later(self.time+self.tick-now, self.run)
+        else:
+            self.handle = None
+
+class ConnTable:
+    def __init__(self, limit=65536, linger=2*MSL):
+        self.limit = limit
+        self.linger = linger
+        self.flows = {}
+        self.expiry = []
+        self.counter = itertools.count()
+    def __len__(self):
+        return len(self.flows)
+    def get(self, key):
+        return self.flows.get(key)
+    def add(self, key, conn):
+        self.purge()
+        if len(self.flows) >= self.limit:
+            # evict closed flows ahead of time
+            self.purge(math.inf)
+            if len(self.flows) >= self.limit:
+                return False
+        self.flows[key] = conn
+        conn.on_close = lambda: self.retire(key, conn)
+        return True
+    def retire(self, key, conn):
+        heapq.heappush(self.expiry, (time.perf_counter()+self.linger, next(self.counter), key, conn))
+    def purge(self, now=None):
+        now = time.perf_counter() if now is None else now
+        while self.expiry and self.expiry[0][0] <= now:
+            _, _, key, conn = heapq.heappop(self.expiry)
+            if self.flows.get(key) is conn:
+                del self.flows[key]
+
+class UDPFlow(asyncio.DatagramProtocol):
+    def __init__(self, dst_name, dst_port, reply, udp_conn, timers, timeout=UDP_TIMEOUT):
+        self.dst_name = dst_name
+        self.dst_port = dst_port
+        self.reply = reply
+        self.udp_conn = udp_conn
+        self.timers = timers
+        self.timeout = timeout
+        self.transport = None
+        self.pending = []
+        self.closed = False
+        self.on_close = None
+        self.update = time.perf_counter()
+        self.timers.schedule(self.update+self.timeout, self.on_idle)
+        asyncio.ensure_future(self.connect())
+    async def connect(self):
+        try:
+            remote = self.udp_conn.destination(self.dst_name, self.dst_port)
+            await asyncio.get_event_loop().create_datagram_endpoint(lambda: self, remote_addr=remote)
+        except Exception:
+            self.close()
+    def connection_made(self, transport):
+        if self.closed:
+            transport.close()
+            return
+        self.transport = transport
+        for data in self.pending:
+            transport.sendto(data)
+        self.pending.clear()
+    def connection_lost(self, exc):
+        self.close()
+    def error_received(self, exc):
+        pass
+    def datagram_received(self, data, addr):
+        self.update = time.perf_counter()
+        try:
+            data = self.udp_conn.udp_packet_unpack(data)
+        except Exception:
+            return
+        self.reply(data)
+    def send(self, data):
+        self.update = time.perf_counter()
+        data = self.udp_conn.udp_prepare_connection(self.dst_name, self.dst_port, data)
+        if self.transport:
+            self.transport.sendto(data)
+        elif len(self.pending) < 64:
+            self.pending.append(data)
+    def on_idle(self):
+        if self.closed:
+            return
+        deadline = self.update+self.timeout
+        if deadline > time.perf_counter()+self.timers.tick/2:
+            self.timers.schedule(deadline, self.on_idle)
+            return
+        self.close()
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.transport:
+            self.transport.close()
+        if self.on_close:
+            self.on_close()
+
 class TCPStack:
-    def __init__(self, src_ip, src_port, dst_ip, dst_name, dst_port, reply, tcp_conn):
+    def __init__(self, src_ip, src_port, dst_ip, dst_name, dst_port, reply, tcp_conn, timers, cc=congestion.NewReno, mss=SMSS, optimistic=False):
         self.src_ip = src_ip
         self.src_port = src_port
         self.dst_ip = dst_ip
@@ -73,27 +385,137 @@ class TCPStack:
         self.dst_port = dst_port
         self.reply = reply
         self.tcp_conn = tcp_conn
+        self.timers = timers
+        self.ip_header = ipv4_header(6, dst_ip, src_ip, df=True)
+        self.pseudo_sum = fold(dst_ip+src_ip, 6)
+        self.congestion = cc
         self.src_seq = 0
         self.dst_seq = self.dst_ack = 0
         self.src_win = []
+        self.src_win_size = 0
         self.dst_win = collections.deque()
-        self.dst_win_buf = bytearray()
+        self.dst_win_buf = SendQueue()
         self.writer = None
+        self.early = bytearray() if optimistic else None
         self.state = State.INITIAL
-        self.cwnd = 2*SMSS if SMSS>2190 else 3*SMSS if SMSS>1095 else 4*SMSS
+        self.mss = mss
+        self.smss = mss
+        self.cc = cc(self.smss)
         self.rwnd = 65535
-        self.ssthresh = 65535
         self.fast_resend = 0
+        self.pace_at = 0
+        self.pace_armed = None
+        self.draining = False
         self.wait_send = asyncio.Event()
-        self.wait_ack = asyncio.Event()
-        self.wait_fast = asyncio.Event()
         self.rto = 3
+        self.rto_at = None
+        self.rto_armed = False
+        self.retries = 0
+        self.on_close = None
+        self.ack_at = None
+        self.ack_armed = False
+        self.ack_pending = 0
         self.srtt = self.rttvar = None
+        self.sack_ok = False
+        self.snd_wscale = self.rcv_wscale = 0
+        self.ts_ok = False
+        self.ts_recent = 0
+        self.sack_high = 0
+        self.recover = 0
+        self.src_last = None
         self.update = time.perf_counter()
-    def obsolete(self):
-        return self.state == State.CLOSED and time.perf_counter() - self.update > 120
+    def window(self):
+        return min(self.cc.cwnd, self.rwnd)
+    def recv_window(self):
+        if not self.writer:
+            return max(0, EARLYBUF-len(self.early)) if self.early is not None else 0
+        return max(0, RCVBUF-self.writer.transport.get_write_buffer_size())
+    def write(self, data):
+        if self.writer:
+            self.writer.write(data)
+        else:
+            # upstream still connecting
+            self.early.extend(data)
+    def push(self):
+        while self.dst_ack+len(self.dst_win_buf) > self.dst_seq and self.dst_seq-self.dst_ack <= self.window():
+            rate = self.cc.pacing_rate
+            if rate:
+                now = time.perf_counter()
+                # one low rate sample must not hold the flow back once the rate recovers
+                self.pace_at = min(self.pace_at, now+self.smss/rate)
+                if self.pace_at-now > self.timers.tick/4:
+                    if not self.pace_armed or self.pace_at < self.pace_armed:
+                        self.pace_armed = self.pace_at
+                        self.timers.schedule(self.pace_at, self.on_pace)
+                    return
+                self.pace_at = max(self.pace_at, now)
+            tcp_body = self.dst_win_buf.peek(self.dst_seq-self.dst_ack, self.smss)
+            self.send(tcp_body)
+            self.dst_win.append([self.dst_seq, len(tcp_body), 0, time.perf_counter(), False])
+            self.dst_seq += len(tcp_body)
+            self.start_rto()
+            self.cc.on_send()
+            if rate:
+                self.pace_at += len(tcp_body)/rate
+    def on_pace(self):
+        self.pace_armed = None
+        if self.state != State.CLOSED:
+            self.push()
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except Exception:
+            pass
+        self.draining = False
+        if self.state in (State.ESTABLISHED, State.FIN_WAIT_1, State.FIN_WAIT_2):
+            # window update
+            self.send()
     def close(self):
-        self.state = State.CLOSED
+        if self.state != State.CLOSED:
+            self.state = State.CLOSED
+            self.rto_at = None
+            if self.on_close:
+                self.on_close()
+    def abort(self):
+        if self.state == State.CLOSED:
+            return
+        self.close()
+        self.send(flag=Control.RST|Control.ACK)
+        self.wait_send.set()
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+    def on_idle(self):
+        if self.state == State.CLOSED:
+            return
+        deadline = self.update+TCP_IDLE
+        if deadline > time.perf_counter()+self.timers.tick/2:
+            self.timers.schedule(deadline, self.on_idle)
+            return
+        self.abort()
+    def start_rto(self, restart=False):
+        if self.rto_at is None or restart:
+            self.rto_at = time.perf_counter()+self.rto
+            if not self.rto_armed:
+                self.rto_armed = True
+                self.timers.schedule(self.rto_at, self.on_rto)
+    def on_rto(self):
+        self.rto_armed = False
+        if self.rto_at is None or self.state == State.CLOSED:
+            return
+        if self.rto_at > time.perf_counter()+self.timers.tick/2:
+            self.rto_armed = True
+            self.timers.schedule(self.rto_at, self.on_rto)
+            return
+        self.rto_at = None
+        if self.dst_seq != self.dst_ack:
+            self.retries += 1
+            if self.retries > RTO_RETRIES:
+                # the client is gone
+                self.abort()
+                return
+            self.retransmit(True)
     def calc_rto(self, r):
         if self.srtt is None:
             self.srtt = r
@@ -102,44 +524,129 @@ class TCPStack:
             self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt-r)
             self.srtt = 0.875*self.srtt + 0.125*r
         self.rto = min(self.srtt + max(0.1, 4*self.rttvar), 60)
-    async def retransmit(self):
-        while self.state != State.CLOSED:
-            if self.dst_seq == self.dst_ack:
-                self.wait_ack.clear()
-                await self.wait_ack.wait()
-            if self.state == State.CLOSED:
-                break
-            seq = self.dst_ack
-            self.wait_fast.clear()
-            timeout = False
-            try:
-                await asyncio.wait_for(self.wait_fast.wait(), self.rto)
-            except asyncio.TimeoutError:
-                timeout = True
-            if self.state == State.CLOSED:
+    def start_ack(self):
+        if self.ack_at is None:
+            self.ack_at = time.perf_counter()+ACK_DELAY
+            if not self.ack_armed:
+                self.ack_armed = True
+                self.timers.schedule(self.ack_at, self.on_ack_timer)
+    def on_ack_timer(self):
+        self.ack_armed = False
+        if self.ack_at is None or self.state == State.CLOSED:
+            return
+        if self.ack_at > time.perf_counter()+self.timers.tick/2:
+            self.ack_armed = True
+            self.timers.schedule(self.ack_at, self.on_ack_timer)
+            return
+        self.ack_at = None
+        if self.ack_pending:
+            self.send()
+    def set_mtu(self, mtu):
+        smss = max(mtu-40-(12 if self.ts_ok else 0), 536)
+        if smss >= self.smss:
+            return
+        self.smss = self.cc.smss = smss
+        entries = list(self.dst_win)
+        self.dst_win.clear()
+        for seq, length, tp, counter, sacked in entries:
+            while length > smss:
+                self.dst_win.append([seq, smss, tp, 0, sacked])
+                seq += smss
+                length -= smss
+            self.dst_win.append([seq, length, tp, 0, sacked])
+        if self.dst_ack < self.dst_seq:
+            self.resend(self.smss)
+    def retransmit(self, timeout):
+        #print('retransmit', self.dst_ip, self.dst_port, self.dst_ack, self.dst_seq, len(self.dst_win_buf), self.rto, timeout)
+        if timeout:
+            # sack information may be reneged after a timeout, and no
+            # outstanding segment gives a valid rtt sample any more
+            self.sack_high = 0
+            for entry in self.dst_win:
+                entry[3] = 0
+                entry[4] = False
+        if timeout:
+            self.rto = min(self.rto*2, 60)
+            self.cc.on_rto(self.dst_seq-self.dst_ack)
+        else:
+            self.cc.on_loss(self.dst_seq-self.dst_ack)
+        self.recover = self.dst_seq
+        self.resend(self.smss if timeout else self.cc.cwnd)
+        self.start_rto(True)
+    def resend(self, limit):
+        for entry in self.dst_win:
+            seq, length, tp, counter, sacked = entry
+            if sacked:
+                continue
+            if limit <= 0 or seq > self.dst_ack and seq >= self.sack_high:
                 break
-            if seq != self.dst_ack:
+            entry[3] = 0
+            start = max(seq, self.dst_ack)-self.dst_ack
+            if tp == 1:
+                self.send(seq=seq, flag=self.dst_win_buf.peek(start, 1)[0])
+            else:
+                self.send(self.dst_win_buf.peek(start, seq+length-self.dst_ack-start), seq=self.dst_ack+start)
+            limit -= length
+    def parse_sack(self, data):
+        for i in range(0, len(data)-7, 8):
+            left, right = struct.unpack('>II', data[i:i+8])
+            while self.dst_ack-left > 0x20000000:
+                left += 0x100000000
+            right = left+((right-left)&0xffffffff)
+            if right <= self.dst_ack or right > self.dst_seq:
                 continue
-            # retransmit
-            #print('retransmit', self.dst_ip, self.dst_port, self.dst_ack, self.dst_seq, len(self.dst_win_buf), self.rto, timeout)
-            flag = None
-            if self.dst_win:
-                self.dst_win[0][3] = 0
-                if self.dst_win[0][0] == self.dst_ack and self.dst_win[0][2] == 1:
-                    flag = self.dst_win_buf[0]
-            if flag is not None:
-                self.send(seq=self.dst_ack, flag=flag)
+            self.sack_high = max(self.sack_high, right)
+            for entry in self.dst_win:
+                if entry[0] >= right:
+                    break
+                if entry[0] >= left and entry[0]+entry[1] <= right:
+                    entry[4] = True
+    def sack_blocks(self, count=4):
+        blocks = []
+        for seq, tcp_body in sorted(self.src_win):
+            end = seq+len(tcp_body)
+            if end <= self.src_seq:
+                continue
+            if blocks and seq <= blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], end)
             else:
-                tcp_body = self.dst_win_buf[:SMSS]
-                self.send(tcp_body, seq=self.dst_ack)
-            if timeout:
-                self.rto = min(self.rto*2, 60)
-                self.ssthresh = max((self.dst_seq-self.dst_ack)//2, 2*SMSS)
-                self.cwnd = self.ssthresh+3*SMSS
+                blocks.append([seq, end])
+        if self.src_last is not None:
+            blocks.sort(key=lambda b: not b[0] <= self.src_last < b[1])
+        return blocks[:count]
+    def timestamp(self):
+        return int(time.perf_counter()*1000) & 0xffffffff
+    def options(self, flag):
+        options = bytearray()
+        if flag & Control.SYN:
+            options.extend(struct.pack('>BBH', Option.MSS, 4, self.mss))
+            if self.rcv_wscale:
+                options.extend(bytes([Option.NOP, Option.WSCALE, 3, self.rcv_wscale]))
+            if self.sack_ok and not self.ts_ok:
+                options.extend(bytes([Option.NOP, Option.NOP, Option.SACK_PERM, 2]))
+            if self.ts_ok:
+                options.extend(bytes([Option.SACK_PERM, 2] if self.sack_ok else [Option.NOP, Option.NOP]))
+                options.extend(struct.pack('>BBII', Option.TIMESTAMP, 10, self.timestamp(), self.ts_recent))
+            return options
+        if self.ts_ok:
+            options.extend(struct.pack('>BBBBII', Option.NOP, Option.NOP, Option.TIMESTAMP, 10, self.timestamp(), self.ts_recent))
+        if self.sack_ok and self.src_win:
+            blocks = self.sack_blocks(3 if self.ts_ok else 4)
+            if blocks:
+                options.extend(bytes([Option.NOP, Option.NOP, Option.SACK, 2+8*len(blocks)]))
+                for i, j in blocks:
+                    options.extend(struct.pack('>II', i&0xffffffff, j&0xffffffff))
+        return options
     def parse(self, ip_body):
         src_port, dst_port, seq, ack, offset, flag, window = struct.unpack('>HHIIBBH', ip_body[:16])
         tcp_body = ip_body[offset>>2:]
-        self.rwnd = window
+        options = parse_tcp_options(ip_body[20:offset>>2]) if offset > 0x50 else {}
+        rwnd, self.rwnd = self.rwnd, window if flag & Control.SYN else window<<self.snd_wscale
+        tsecr = None
+        if self.ts_ok and len(options.get(Option.TIMESTAMP, b'')) == 8:
+            tsval, tsecr = struct.unpack('>II', options[Option.TIMESTAMP])
+            if (self.src_seq-seq) & 0xffffffff < 0x80000000:
+                self.ts_recent = tsval
         self.update = time.perf_counter()
         #print('RECV', self.dst_name, self.dst_port, self.state, Control(flag), seq, ack, len(tcp_body))
         if self.state == State.CLOSED:
@@ -158,11 +665,24 @@ class TCPStack:
                 self.state = State.SYN_RECEIVED
                 self.src_seq = seq+1
                 self.dst_seq = self.dst_ack = random.randrange(0x100000000)
+                self.sack_ok = Option.SACK_PERM in options
+                if len(options.get(Option.WSCALE, b'')) == 1:
+                    self.snd_wscale = min(options[Option.WSCALE][0], 14)
+                    self.rcv_wscale = WSCALE
+                if len(options.get(Option.TIMESTAMP, b'')) == 8:
+                    self.ts_ok = True
+                    self.ts_recent = int.from_bytes(options[Option.TIMESTAMP][:4], 'big')
+                if len(options.get(Option.MSS, b'')) == 2:
+                    self.smss = min(self.mss, int.from_bytes(options[Option.MSS], 'big'))
+                else:
+                    self.smss = min(self.mss, 536)
+                # data segments carry the timestamp option
+                self.smss -= 12 if self.ts_ok else 0
+                self.cc = self.congestion(self.smss)
+                self.timers.schedule(self.update+TCP_IDLE, self.on_idle)
                 asyncio.ensure_future(self.connect())
-                asyncio.ensure_future(self.retransmit())
         elif flag & Control.RST:
             self.close()
-            self.wait_ack.set()
             self.wait_send.set()
             try:
                 self.writer.close()
@@ -173,58 +693,87 @@ class TCPStack:
         elif flag & Control.ACK == 0:
             pass
         else:
-            if self.state == State.SYN_RECEIVED:
+            handshake = self.state == State.SYN_RECEIVED
+            if handshake:
                 self.state = State.ESTABLISHED
             while self.dst_ack-ack > 0x20000000:
                 ack += 0x100000000
             if self.dst_ack < self.dst_seq:
                 diff_ack = ack-self.dst_ack
-                if diff_ack == 0 and not tcp_body:
+                if self.sack_ok and Option.SACK in options:
+                    self.parse_sack(options[Option.SACK])
+                if diff_ack == 0 and not tcp_body and rwnd == self.rwnd:
                     self.fast_resend += 1
-                    if self.fast_resend < 3:
-                        self.wait_send.set()
-                    elif self.fast_resend == 3:
-                        self.wait_fast.set()
-                    else:
-                        self.cwnd += SMSS
+                    if self.fast_resend == 3 and self.dst_ack >= self.recover:
+                        self.retransmit(False)
+                    elif self.fast_resend > 3:
+                        self.cc.on_ack(0, None, self.dst_seq-self.dst_ack, self.dst_ack < self.recover)
                 if diff_ack > 0:
                     self.fast_resend = 0
-                    counter = 0
+                    self.retries = 0
+                    counter, sacked = 0, False
                     while self.dst_win and self.dst_win[0][0]+self.dst_win[0][1] <= ack:
-                        seq, length, tp, counter = self.dst_win.popleft()
-                    del self.dst_win_buf[:diff_ack]
+                        _, _, _, counter, sacked = self.dst_win.popleft()
+                    self.dst_win_buf.consume(diff_ack)
                     self.dst_ack = ack
-                    self.wait_fast.set()
-                    if self.dst_seq-self.dst_ack <= min(self.cwnd, self.rwnd):
-                        self.wait_send.set()
-                    if self.cwnd < self.ssthresh:
-                        self.cwnd += min(diff_ack, SMSS)
+                    if self.dst_ack < self.dst_seq:
+                        self.start_rto(True)
                     else:
-                        self.cwnd += SMSS*SMSS//self.cwnd
-                    if counter == 0:
-                        self.cwnd = self.ssthresh
-                    if counter > 0:
-                        time_diff = time.perf_counter() - counter
-                        self.calc_rto(time_diff)
+                        self.rto_at = None
+                    if self.dst_ack < self.recover:
+                        # partial ack, the next hole will not trigger dup acks
+                        self.resend(self.smss)
+                    rtt = None
+                    if tsecr:
+                        rtt = ((self.timestamp()-tsecr) & 0xffffffff)/1000
+                    elif counter > 0 and not sacked:
+                        rtt = time.perf_counter() - counter
+                    if rtt is not None:
+                        self.calc_rto(rtt)
+                    # the syn is not data, it must not feed bandwidth samples
+                    acked = diff_ack-1 if handshake else diff_ack
+                    if acked:
+                        self.cc.on_ack(acked, rtt, self.dst_seq-self.dst_ack, self.dst_ack < self.recover)
+                    self.wait_send.set()
+                self.push()
             if self.state == State.FIN_WAIT_1:
                 if self.dst_ack >= self.dst_seq:
                     self.state = State.FIN_WAIT_2
+            elif self.state == State.LAST_ACK:
+                if self.dst_ack >= self.dst_seq:
+                    self.close()
             if tcp_body and self.state in (State.ESTABLISHED, State.FIN_WAIT_1, State.FIN_WAIT_2):
                 while self.src_seq-seq > 0x20000000:
                     seq += 0x100000000
+                quick = True
                 if seq+len(tcp_body) <= self.src_seq:
                     pass
+                elif seq+len(tcp_body) > self.src_seq+max(self.recv_window(), self.smss):
+                    # beyond the advertised window
+                    pass
                 elif seq <= self.src_seq:
-                    self.writer.write(tcp_body[self.src_seq-seq:])
+                    self.write(tcp_body[self.src_seq-seq:])
+                    self.ack_pending += seq+len(tcp_body)-self.src_seq
                     self.src_seq = seq+len(tcp_body)
+                    # a segment that fills a hole is acked at once
+                    quick = bool(self.src_win)
                     while self.src_win and self.src_win[0][0] <= self.src_seq:
                         seq, tcp_body = heapq.heappop(self.src_win)
+                        self.src_win_size -= len(tcp_body)
                         if seq+len(tcp_body) > self.src_seq:
-                            self.writer.write(tcp_body[self.src_seq-seq:])
+                            self.write(tcp_body[self.src_seq-seq:])
                             self.src_seq = seq+len(tcp_body)
-                elif seq-self.src_seq < 0x20000000:
+                elif self.src_win_size+len(tcp_body) <= RCVBUF//2:
                     heapq.heappush(self.src_win, (seq, tcp_body))
-                self.send()
+                    self.src_win_size += len(tcp_body)
+                    self.src_last = seq
+                if self.writer and not self.draining and self.recv_window() < RCVBUF//2:
+                    self.draining = True
+                    asyncio.ensure_future(self.drain())
+                if quick or self.ack_pending >= 2*self.smss:
+                    self.send()
+                else:
+                    self.start_ack()
             if flag & Control.FIN:
                 while self.src_seq-seq > 0x20000000:
                     seq += 0x100000000
@@ -241,72 +790,87 @@ class TCPStack:
                             pass
                     elif self.state == State.FIN_WAIT_2:
                         self.close()
-                        self.wait_ack.set()
     def send(self, tcp_body=b'', *, flag=Control.ACK, seq=None, ack=None):
         self.update = time.perf_counter()
-        window = max(0, (65535-len(self.writer.transport._buffer)) if self.writer else 0)
+        if ack is None and flag & Control.ACK:
+            self.ack_pending = 0
+            self.ack_at = None
+        window = self.recv_window()
+        window = min(window if flag & Control.SYN else window>>self.rcv_wscale, 65535)
         #print('SEND', self.dst_name, self.dst_port, self.state, Control(flag), (self.dst_seq if seq is None else seq), (self.src_seq if ack is None else ack), len(tcp_body))
-        tcp_header = struct.pack('>HHIIBBHHH', self.dst_port, self.src_port, (self.dst_seq if seq is None else seq)&0xffffffff, (self.src_seq if ack is None else ack)&0xffffffff, 5<<4, flag, window, 0, 0)
-        ip_body = bytearray(tcp_header + tcp_body)
-        tochecksum = bytearray(self.dst_ip.packed+self.src_ip.packed+b'\x00\x06'+len(ip_body).to_bytes(2, 'big') + ip_body)
-        if len(tochecksum) % 2 == 1:
-            tochecksum.extend(b'\x00')
-        ip_body[16:18] = checksum(tochecksum)
-        data = make_ipv4(6, self.dst_ip, self.src_ip, ip_body)
+        options = self.options(flag)
+        tcp_header = bytearray(TCP_HEADER.pack(self.dst_port, self.src_port, (self.dst_seq if seq is None else seq)&0xffffffff, (self.src_seq if ack is None else ack)&0xffffffff, (5+len(options)//4)<<4, flag, window, 0, 0))
+        tcp_header.extend(options)
+        length = len(tcp_header)+len(tcp_body)
+        tcp_header[16:18] = checksum(tcp_body, fold(tcp_header, self.pseudo_sum+length))
+        data = b''.join((ipv4_resize(self.ip_header, length), tcp_header, tcp_body))
         if not self.reply(data):
             self.close()
-            self.wait_ack.set()
             self.wait_send.set()
             try:
                 self.writer.close()
             except Exception:
                 pass
+    def send_synack(self):
+        self.send(flag=Control.ACK|Control.SYN)
+        self.dst_win.append([self.dst_seq, 1, 1, time.perf_counter(), False])
+        self.dst_win_buf.extend(bytes([Control.ACK|Control.SYN]))
+        self.dst_seq += 1
+        self.start_rto()
     async def connect(self):
         #print(f'connect {self.dst_ip}:{self.dst_port}')
-        total = 0
+        optimistic = self.early is not None
+        if optimistic:
+            self.send_synack()
         try:
-            reader, self.writer = await self.tcp_conn.tcp_connect(self.dst_name, self.dst_port)
+            reader, writer = await self.tcp_conn.tcp_connect(self.dst_name, self.dst_port)
         except Exception:
             # connect fail
-            self.close()
-            self.wait_ack.set()
-            self.send(flag=Control.RST)
+            if self.state != State.CLOSED:
+                self.close()
+                self.send(flag=Control.RST|Control.ACK if optimistic else Control.RST)
             return
-        self.send(flag=Control.ACK|Control.SYN)
-        self.dst_win.append([self.dst_seq, 1, 1, time.perf_counter()])
-        self.dst_win_buf.extend(bytes([Control.ACK|Control.SYN]))
-        self.dst_seq += 1
-        self.wait_ack.set()
-        while True:
+        if self.state == State.CLOSED:
+            writer.close()
+            return
+        self.writer = writer
+        if not optimistic:
+            self.send_synack()
+        elif self.early:
+            self.writer.write(self.early)
+            self.early = None
+            # reopen the window
+            self.send()
+        if self.state == State.CLOSE_WAIT:
+            self.writer.close()
+        while self.state != State.CLOSED:
+            if len(self.dst_win_buf) >= SNDBUF:
+                # stop reading upstream until the client acks enough data
+                self.wait_send.clear()
+                await self.wait_send.wait()
+                continue
             try:
                 data = await reader.read_()
             except Exception:
                 data = None
             if not data:
                 break
-            data = bytearray(data)
-            while data:
-                if self.dst_seq-self.dst_ack > min(self.cwnd, self.rwnd):
-                    self.wait_send.clear()
-                    await self.wait_send.wait()
-                    if self.state == State.CLOSED:
-                        break
-                tcp_body = data[:SMSS]
-                del data[:SMSS]
-                total += len(tcp_body)
-                self.send(tcp_body)
-                self.dst_win.append([self.dst_seq, len(tcp_body), 0, time.perf_counter()])
-                self.dst_win_buf.extend(tcp_body)
-                self.dst_seq += len(tcp_body)
-                self.wait_ack.set()
+            self.dst_win_buf.extend(data)
+            self.push()
+        while self.state != State.CLOSED and self.dst_ack+len(self.dst_win_buf) > self.dst_seq:
+            self.wait_send.clear()
+            await self.wait_send.wait()
         if self.state == State.CLOSE_WAIT:
             self.send(flag=Control.ACK|Control.FIN)
+            self.dst_win.append([self.dst_seq, 1, 1, time.perf_counter(), False])
             self.dst_win_buf.extend(bytes([Control.ACK|Control.FIN]))
             self.dst_seq += 1
-            self.wait_ack.set()
-            self.close()
+            self.state = State.LAST_ACK
+            self.start_rto()
         elif self.state != State.CLOSED:
             self.send(flag=Control.ACK|Control.FIN)
             self.state = State.FIN_WAIT_1
+            self.dst_win.append([self.dst_seq, 1, 1, time.perf_counter(), False])
             self.dst_win_buf.extend(bytes([Control.ACK|Control.FIN]))
             self.dst_seq += 1
+            self.start_rto()
@@ -0,0 +1,58 @@
+import asyncio, collections, time
+
+class ConnectionPool:
+    def __init__(self, conn, size, idle=30):
+        self.conn = conn
+        self.size = size
+        self.idle = idle
+        self.conns = collections.deque()
+        self.opening = 0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.latency = dict(hit=None, miss=None)
+    def __str__(self):
+        latency = ' '.join(f'{k}={v*1000:.0f}ms' for k, v in self.latency.items() if v is not None)
+        return f'Pool {len(self.conns)}/{self.size} Hits={self.hits} Misses={self.misses} Failures={self.failures} {latency}'
+    def sample(self, kind, start):
+        rtt = time.perf_counter()-start
+        last = self.latency[kind]
+        self.latency[kind] = rtt if last is None else 0.875*last+0.125*rtt
+    def refill(self):
+        while len(self.conns)+self.opening < self.size:
+            self.opening += 1
+            asyncio.ensure_future(self.open())
+    async def open(self):
+        try:
+            # the target is bound later by prepare_connection
+            reader, writer = await self.conn.open_connection(None, None, None, None)
+        except Exception:
+            self.failures += 1
+        else:
+            self.conns.append((time.perf_counter(), reader, writer))
+        finally:
+            self.opening -= 1
+    async def tcp_connect(self, host, port):
+        while self.conns:
+            stamp, reader, writer = self.conns.popleft()
+            if time.perf_counter()-stamp > self.idle or reader.at_eof() or writer.transport.is_closing():
+                writer.close()
+                continue
+            self.refill()
+            start = time.perf_counter()
+            try:
+                reader, writer = await self.conn.prepare_connection(reader, writer, host, port)
+            except Exception:
+                # the proxy dropped it while idle, try the next one
+                writer.close()
+                self.failures += 1
+                continue
+            self.hits += 1
+            self.sample('hit', start)
+            return reader, writer
+        self.misses += 1
+        self.refill()
+        start = time.perf_counter()
+        reader, writer = await self.conn.tcp_connect(host, port)
+        self.sample('miss', start)
+        return reader, writer
@@ -1,6 +1,6 @@
-import argparse, asyncio, io, os, enum, struct, collections, hashlib, ipaddress, socket, random
+import argparse, asyncio, io, os, enum, struct, collections, hashlib, ipaddress, socket, random, time
 import pproxy
-from . import enums, message, crypto, ip, dns
+from . import enums, message, crypto, ip, dns, congestion, pool
 from .__doc__ import *
 
 class State(enum.Enum):
@@ -383,8 +383,58 @@ class IKE_500(asyncio.DatagramProtocol):
 class SPE_4500(IKE_500):
     def __init__(self, args, sessions):
         IKE_500.__init__(self, args, sessions)
-        self.tcp_stack = {}
+        self.tcp_stack = ip.ConnTable(args.conns)
+        self.udp_flows = ip.ConnTable(args.conns, linger=0)
+        self.timers = ip.TimerWheel()
+        self.fragments = ip.Reassembler()
         self.dnscache = dns.DNSCache()
+        self.dnscache.refresh = self.dns_refresh
+        self.dns_flow = None
+        self.dns_tcp = {}
+        self.zone = None
+        if args.zone:
+            self.zone = dns.LocalZone()
+            self.zone.load(args.zone)
+            self.dnscache.add_rdns(self.zone.rdns(), float('inf'))
+            print(f'Loaded {len(self.zone)} local names from {args.zone}')
+        if args.dnsfile:
+            try:
+                self.dnscache.load(args.dnsfile)
+                print(f'Loaded {len(self.dnscache.cache)} dns answers from {args.dnsfile}')
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f'Load {args.dnsfile} failed: {e}')
+            asyncio.get_event_loop().call_later(300, self.save_dns)
+    def save_dns(self):
+        try:
+            self.dnscache.save(self.args.dnsfile)
+        except Exception as e:
+            print(f'Save {self.args.dnsfile} failed: {e}')
+        asyncio.get_event_loop().call_later(300, self.save_dns)
+    def domain(self, packed_ip):
+        return self.dnscache.ip2domain(socket.inet_ntoa(packed_ip))
+    def dns_resolver(self, host):
+        resolver = self.dns_tcp.get(host)
+        if resolver is None:
+            resolver = self.dns_tcp[host] = dns.TCPResolver(self.args.rserver, host, size=self.args.dnstcp)
+        return resolver
+    def dns_refresh(self, qkey):
+        packet = os.urandom(2)+b'\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'+qkey
+        if self.args.dnstcp:
+            self.dns_resolver(self.args.dns).query(packet, self.dns_refreshed)
+            return
+        if self.dns_flow is None or self.dns_flow.closed:
+            self.dns_flow = ip.UDPFlow(self.args.dns, 53, self.dns_refreshed, self.args.urserver, self.timers)
+        self.dns_flow.send(packet)
+    def dns_refreshed(self, data):
+        if data is None:
+            return
+        try:
+            self.dnscache.answer(data)
+            self.dnscache.release(data)
+        except Exception as e:
+            print(e)
     def datagram_received(self, data, addr):
         spi = data[:4]
         if spi == b'\xff':
@@ -421,53 +471,103 @@ class SPE_4500(IKE_500):
                 self.transport.sendto(encrypted, addr)
                 return True
             if header == enums.IpProto.IPV4:
+                data = self.fragments.feed(data, addr)
+                if data is None:
+                    return
                 proto, src_ip, dst_ip, ip_body = ip.parse_ipv4(data)
-                dst_name = self.dnscache.ip2domain(str(dst_ip))
+                mtu = sa.crypto_out.esp_mtu(self.args.mtu)
+                if data[6] & 0x40 and int.from_bytes(data[2:4], 'big') > mtu and (proto != enums.IpProto.ICMP or ip_body[0] in (0, 8)):
+                    print(f'IPv4 {enums.IpProto(proto).name} -> {self.domain(dst_ip)} Fragmentation Needed MTU={mtu}')
+                    reply(ip.make_ipv4(enums.IpProto.ICMP, dst_ip, src_ip, ip.frag_needed(data, mtu)))
+                    return
                 if proto == enums.IpProto.UDP:
                     src_port, dst_port, udp_body = ip.parse_udp(ip_body)
-                    if dst_port == 53:
-                        try:
-                            record = dns.DNSRecord.unpack(udp_body)
-                            answer = self.dnscache.query(record)
-                            print(f'IPv4 DNS -> {dst_name}:{dst_port} Query={record.q.qname}{" (Cached)" if answer else ""}')
-                            if answer:
-                                ip_body = ip.make_udp(dst_port, src_port, answer.pack())
-                                data = ip.make_ipv4(proto, dst_ip, src_ip, ip_body)
-                                reply(data)
-                                return
-                        except Exception as e:
-                            print(e)
-                    else:
+                    key = (addr, src_ip, src_port, dst_ip, dst_port)
+                    flow = self.udp_flows.get(key)
+                    question = dns.parse_question(udp_body) if dst_port == 53 else None
+                    if question:
+                        dst_name = self.domain(dst_ip)
+                        qid, qkey, qname = question
+                        limit = dns.udp_limit(udp_body)
+                        local = answer = self.zone and self.zone.answer(udp_body, question)
+                        if not answer:
+                            answer = self.dnscache.query(qkey, qid, qname)
+                        print(f'IPv4 DNS -> {dst_name}:{dst_port} Query={dns.question_name(qkey)}{" (Local)" if local else " (Cached)" if answer else ""}')
+                        if answer:
+                            ip_body = ip.make_udp(dst_port, src_port, dns.truncate(answer, limit))
+                            data = ip.make_ipv4(proto, dst_ip, src_ip, ip_body)
+                            reply(data)
+                            return
+                        def respond(answer):
+                            reply(ip.make_ipv4(proto, dst_ip, src_ip, ip.make_udp(dst_port, src_port, dns.truncate(answer, limit))))
+                        if self.dnscache.join(qkey, qid, qname, respond, (addr, src_ip, src_port)):
+                            return
+                        if qkey in self.dnscache.cache:
+                            # expired, fall back to the stale answer if the upstream is slow
+                            self.timers.schedule(time.perf_counter()+self.dnscache.client_timeout, lambda: self.dnscache.expire(qkey))
+                    if flow is not None and not flow.closed:
+                        flow.send(udp_body)
+                        return
+                    dst_name = self.domain(dst_ip)
+                    if dst_port != 53:
                         print(f'IPv4 UDP -> {dst_name}:{dst_port} Length={len(udp_body)}')
                     def udp_reply(udp_body):
                         #print(f'IPv4 UDP Reply {dst_ip}:{dst_port} -> {src_ip}:{src_port}', result)
+                        if udp_body is None:
+                            # the tcp upstream failed
+                            self.dnscache.cancel(qkey)
+                            return
                         if dst_port == 53:
-                            record = dns.DNSRecord.unpack(udp_body)
-                            if not self.args.nocache:
-                                self.dnscache.answer(record)
+                            record = dns.DNSRecord.unpack(udp_body) if self.args.nocache else self.dnscache.answer(udp_body)
+                            udp_body = self.dnscache.release(udp_body)
+                            if flow is None:
+                                # answers over tcp may not fit what the client accepts
+                                udp_body = dns.truncate(udp_body, limit)
                             print(f'IPv4 DNS <- {dst_name}:{dst_port} Answer=['+' '.join(f'{r.rname}->{r.rdata}' for r in record.rr)+']')
+                            if self.args.v:
+                                print(self.dnscache)
                         else:
                             print(f'IPv4 UDP <- {dst_name}:{dst_port} Length={len(udp_body)}')
                         ip_body = ip.make_udp(dst_port, src_port, udp_body)
                         data = ip.make_ipv4(proto, dst_ip, src_ip, ip_body)
-                        reply(data)
-                    asyncio.ensure_future(self.args.urserver.udp_sendto(dst_name, dst_port, udp_body, udp_reply, (str(src_ip), src_port)))
+                        if not reply(data) and flow is not None:
+                            flow.close()
+                    if question and self.args.dnstcp:
+                        flow = None
+                        self.dns_resolver(dst_name).query(udp_body, udp_reply)
+                        return
+                    flow = ip.UDPFlow(dst_name, dst_port, udp_reply, self.args.urserver, self.timers, 10 if dst_port == 53 else ip.UDP_TIMEOUT)
+                    if not self.udp_flows.add(key, flow):
+                        flow.close()
+                        if question:
+                            self.dnscache.cancel(question[1])
+                        return
+                    flow.send(udp_body)
                 elif proto == enums.IpProto.TCP:
                     src_port, dst_port, flag, tcp_body = ip.parse_tcp(ip_body)
                     #else:
                     #    print(f'IPv4 TCP {src_ip}:{src_port} -> {dst_ip}:{dst_port}', ip_body)
-                    key = (addr[0], src_port)
-                    if key not in self.tcp_stack:
-                        if flag & 2:
-                            print(f'IPv4 TCP -> {dst_name}:{dst_port} Connect')
-                        for spi, tcp in list(self.tcp_stack.items()):
-                            if tcp.obsolete():
-                                self.tcp_stack.pop(spi)
-                        self.tcp_stack[key] = tcp = ip.TCPStack(src_ip, src_port, dst_ip, dst_name, dst_port, reply, self.args.rserver)
-                    else:
-                        tcp = self.tcp_stack[key]
+                    key = (addr, src_ip, src_port, dst_ip, dst_port)
+                    tcp = self.tcp_stack.get(key)
+                    if tcp is None or flag & 2 and tcp.state == ip.State.CLOSED:
+                        if not flag & 2:
+                            # no state for stray segments
+                            data = ip.make_rst(src_ip, dst_ip, ip_body)
+                            if data:
+                                reply(data)
+                            return
+                        dst_name = self.domain(dst_ip)
+                        print(f'IPv4 TCP -> {dst_name}:{dst_port} Connect')
+                        if self.args.v and isinstance(self.args.rserver, pool.ConnectionPool):
+                            print(self.args.rserver)
+                        mss = mtu-40
+                        tcp = ip.TCPStack(src_ip, src_port, dst_ip, dst_name, dst_port, reply, self.args.rserver, self.timers, congestion.ALGORITHMS[self.args.cc], mss, self.args.optimistic)
+                        if not self.tcp_stack.add(key, tcp):
+                            print(f'IPv4 TCP -> {dst_name}:{dst_port} Dropped, {len(self.tcp_stack)} connections')
+                            return
                     tcp.parse(ip_body)
                 elif proto == enums.IpProto.ICMP:
+                    dst_name = self.domain(dst_ip)
                     icmptp, code, icmp_body = ip.parse_icmp(ip_body)
                     if icmptp == 0:
                         tid, seq = struct.unpack('>HH', ip_body[4:8])
@@ -482,11 +582,20 @@ class SPE_4500(IKE_500):
                     elif icmptp == 3 and code == 3:
                         eproto, esrc_ip, edst_ip, eip_body = ip.parse_ipv4(icmp_body)
                         eport = int.from_bytes(eip_body[2:4], 'big')
-                        print(f'IPv4 ICMP -> {dst_name} {eproto.name} :{eport} Denied')
+                        print(f'IPv4 ICMP -> {dst_name} {enums.IpProto(eproto).name} :{eport} Denied')
+                    elif icmptp == 3 and code == 4:
+                        mtu = int.from_bytes(ip_body[6:8], 'big')
+                        eproto, esrc_ip, edst_ip, eip_body = ip.parse_ipv4(icmp_body)
+                        if eproto == enums.IpProto.TCP:
+                            esrc_port, edst_port = struct.unpack('>HH', eip_body[:4])
+                            tcp = self.tcp_stack.get((addr, edst_ip, edst_port, esrc_ip, esrc_port))
+                            if tcp and mtu >= 68:
+                                tcp.set_mtu(mtu)
+                        print(f'IPv4 ICMP -> {dst_name} {enums.IpProto(eproto).name} Fragmentation Needed MTU={mtu}')
                     else:
                         print(f'IPv4 ICMP -> {dst_name} Data={ip_body}')
                 else:
-                    print(f'IPv4 {enums.IpProto(proto).name} -> {dst_name} Data={data}')
+                    print(f'IPv4 {enums.IpProto(proto).name} -> {self.domain(dst_ip)} Data={data}')
             else:
                 print(f'{enums.IpProto(header).name} Unhandled Protocol. Data={data}')
         else:
@@ -501,13 +610,24 @@ def main():
     parser.add_argument('-p', dest='passwd', default='test', help='password (default: test)')
     parser.add_argument('-dns', dest='dns', default='1.1.1.1', help='dns server (default: 1.1.1.1)')
     parser.add_argument('-nc', dest='nocache', default=None, action='store_true', help='do not cache dns (default: off)')
+    parser.add_argument('-zone', dest='zone', default=None, help='local zone or hosts file answered by the gateway')
+    parser.add_argument('-dtcp', dest='dnstcp', default=0, type=int, help='pipelined tcp connections per upstream dns server (default: 0, use udp)')
+    parser.add_argument('-dc', dest='dnsfile', default=None, help='dns cache snapshot file, saved every 5 minutes')
+    parser.add_argument('-mtu', dest='mtu', default=1460, type=int, help='path mtu to clients (default: 1460)')
+    parser.add_argument('-conns', dest='conns', default=65536, type=int, help='max tcp connections (default: 65536)')
+    parser.add_argument('-osyn', dest='optimistic', default=False, action='store_true', help='answer tcp syn before upstream connects (default: off)')
+    parser.add_argument('-pool', dest='pool', default=0, type=int, help='pre-connected sockets to tcp remote server (default: 0)')
+    parser.add_argument('-cc', dest='cc', default='newreno', choices=list(congestion.ALGORITHMS), help='tcp congestion control (default: newreno)')
     parser.add_argument('-v', dest='v', action='count', help='print verbose output')
     parser.add_argument('--version', action='version', version=f'{__title__} {__version__}')
     args = parser.parse_args()
     loop = asyncio.get_event_loop()
+    if args.pool > 0 and args.rserver is not DIRECT:
+        args.rserver = pool.ConnectionPool(args.rserver, args.pool)
+        args.rserver.refill()
     sessions = {}
     transport1, _ = loop.run_until_complete(loop.create_datagram_endpoint(lambda: IKE_500(args, sessions), ('0.0.0.0', 500)))
-    transport2, _ = loop.run_until_complete(loop.create_datagram_endpoint(lambda: SPE_4500(args, sessions), ('0.0.0.0', 4500)))
+    transport2, spe = loop.run_until_complete(loop.create_datagram_endpoint(lambda: SPE_4500(args, sessions), ('0.0.0.0', 4500)))
     print('Serving on UDP :500 :4500...')
     try:
         loop.run_forever()
@@ -517,6 +637,8 @@ def main():
         task.cancel()
     transport1.close()
     transport2.close()
+    if args.dnsfile:
+        spe.dnscache.save(args.dnsfile)
     loop.run_until_complete(loop.shutdown_asyncgens())
     loop.close()
 